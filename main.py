@@ -1,30 +1,219 @@
 import os
 import sys
 import asyncio
-import mimetypes
 import logging
+import random
 import time
-import traceback
 import tempfile
+import functools
+import uuid
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 import httpx
+import orjson
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from supabase import create_client
+from telethon.errors import FloodWaitError
 
-# 日志配置优化
+# cryptg 提供 C 实现的 MTProto AES-IGE，Telethon 检测到后自动启用
+# 纯 Python 加解密是大媒体下载的头号瓶颈 (慢 ~7 倍)
+try:
+    import cryptg  # noqa: F401
+    _HAS_CRYPTG = True
+except ImportError:
+    _HAS_CRYPTG = False
+
+# 日志配置优化 (LOG_LEVEL=WARNING 可在并发抓取时关掉逐条 INFO，减少 stdout 写放大)
+# 非法取值回退 INFO：直接传给 basicConfig 会在 import 阶段抛 ValueError，
+# 那时报警通道还没就绪，任务会无声死掉
+_LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+if _LOG_LEVEL not in ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'):
+    _LOG_LEVEL = 'INFO'
 logging.basicConfig(
-    level=logging.INFO,
+    level=_LOG_LEVEL,
     format='%(asctime)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
-    stream=sys.stdout 
+    stream=sys.stdout
 )
 logger = logging.getLogger(__name__)
+if _LOG_LEVEL != os.environ.get('LOG_LEVEL', 'INFO').upper():
+    logger.warning(f"⚠️ Unknown LOG_LEVEL '{os.environ['LOG_LEVEL']}', falling back to INFO.")
 
 # 优先加载报警配置
 N8N_WEBHOOK_URL = os.environ.get('N8N_WEBHOOK_URL')
 N8N_AUTH_TOKEN = os.environ.get('N8N_AUTH_TOKEN')
 
+# Telegram 媒体只会出现这几种格式，查表即可，省掉 mimetypes 的懒加载和逐次匹配
+_MIME = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.mp4': 'video/mp4',
+    '.mov': 'video/quicktime',
+    '.webm': 'video/webm',
+    '.gif': 'image/gif',
+    '.mp3': 'audio/mpeg',
+    '.ogg': 'audio/ogg',
+    '.pdf': 'application/pdf',
+}
+
+def parse_channel_map(env_str):
+    """
+    解析 TARGET_CHANNELS 环境变量 -> {channel: brand} 映射 (纯函数，便于复用)
+    partition 只在第一个冒号处切分：条目里 brand 含冒号时不再被整条丢弃
+    """
+    channel_map = {}
+    for item in env_str.split(','):
+        key, _, val = item.strip().partition(':')
+        key = key.strip()
+        if key:
+            channel_map[key] = val.strip() or "Uncategorized"
+    return channel_map
+
+@functools.lru_cache(maxsize=1)
+def get_client(session_string, api_id, api_hash):
+    """
+    Telethon 客户端工厂
+    进程内只构造一次，防止同一 session string 被两个客户端抢锁/双重连接
+    """
+    return TelegramClient(
+        StringSession(session_string),
+        api_id,
+        api_hash,
+        connection_retries=1,
+        auto_reconnect=True,
+        request_retries=3,
+        device_model="N8N_Worker_Server",
+        system_version="Linux_Railway_Env",
+        app_version="2.0.0"
+    )
+
+# 全局 HTTP 客户端 (连接池复用，省掉每次调用的 TLS 握手)
+_HTTP = None
+
+class SbClient:
+    """
+    轻量 Supabase REST 封装
+    只覆盖本脚本用到的端点，省掉 supabase-py 全家桶 (postgrest/gotrue/storage3/realtime)
+    的冷启动导入和内存开销
+    """
+
+    def __init__(self, base_url, key):
+        self.base_url = base_url.rstrip('/')
+        self._headers = {"apikey": key, "Authorization": f"Bearer {key}"}
+
+    async def select_archive(self, channels, since_iso, page_size=1000):
+        """
+        批量查询 daily_post_archive 历史记录 (查重预加载用)
+        PostgREST 默认单次响应上限 1000 行且静默截断，
+        用 Range 头分页拉到不足一页为止，保证查重集合完整
+        """
+        http_client = await get_http()
+        rows = []
+        offset = 0
+        while True:
+            r = await http_client.get(
+                f"{self.base_url}/rest/v1/daily_post_archive",
+                params={
+                    "select": "message_id,grouped_id,source_channel,brand",
+                    "source_channel": f"in.({','.join(channels)})",
+                    "inserted_at": f"gte.{since_iso}",
+                    "order": "inserted_at.asc"
+                },
+                headers={**self._headers, "Range": f"{offset}-{offset + page_size - 1}"}
+            )
+            r.raise_for_status()
+            page = r.json()
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+            offset += page_size
+
+    async def insert_archive(self, rows):
+        """
+        批量写入 daily_post_archive (一次往返插入 N 行，不要求返回行数据)
+        resolution=merge-duplicates 兜底：查重漏网的行走 upsert，
+        不会因唯一约束冲突让整批插入失败
+        on_conflict 显式指向查重键 (source_channel, message_id)：
+        不带它 PostgREST 只按主键合并，漏网行照样 409 拖垮整批
+        """
+        http_client = await get_http()
+        r = await http_client.post(
+            f"{self.base_url}/rest/v1/daily_post_archive",
+            params={"on_conflict": "source_channel,message_id"},
+            content=orjson.dumps(rows),
+            headers={**self._headers, "Prefer": "return=minimal,resolution=merge-duplicates", "Content-Type": "application/json"}
+        )
+        r.raise_for_status()
+
+    async def remove(self, bucket, paths):
+        """批量删除 Storage 对象"""
+        http_client = await get_http()
+        r = await http_client.request(
+            "DELETE",
+            f"{self.base_url}/storage/v1/object/{bucket}",
+            content=orjson.dumps({"prefixes": paths}),
+            headers={**self._headers, "Content-Type": "application/json"}
+        )
+        r.raise_for_status()
+
+async def get_http():
+    """懒加载全局 AsyncClient，所有 async 调用共享同一个连接池"""
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            timeout=15
+        )
+    return _HTTP
+
+async def close_http():
+    """关闭全局 AsyncClient (必须在创建它的事件循环内调用)"""
+    global _HTTP
+    if _HTTP is not None:
+        await _HTTP.aclose()
+        _HTTP = None
+
+class AdaptiveLimiter:
+    """
+    自适应并发限制器 (仿 TCP 拥塞控制)
+    成功一次并发上限加性 +1，触发限流则乘性减半，
+    在 Telegram 的限流包络内自动逼近最大吞吐，无需人工调参
+    """
+
+    def __init__(self, min_concurrency=1, max_concurrency=8, initial=2):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self._limit = max(min_concurrency, min(initial, max_concurrency))
+        self._active = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self._limit)
+            self._active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    async def on_success(self):
+        """加性增：一个任务顺利跑完，放宽一个并发位"""
+        async with self._cond:
+            if self._limit < self.max_concurrency:
+                self._limit += 1
+                self._cond.notify_all()
+
+    async def on_overload(self):
+        """乘性减：被限流了，并发上限减半"""
+        async with self._cond:
+            self._limit = max(self.min_concurrency, self._limit // 2)
+            logger.warning(f"⚠️ Concurrency limit lowered to {self._limit} after overload.")
+
 # 核心功能函数
 async def send_alert(message, level="Critical"):
     """
@@ -36,60 +225,298 @@ async def send_alert(message, level="Critical"):
         return
 
     try:
-        async with httpx.AsyncClient() as http_client:
-            await http_client.post(
-                N8N_WEBHOOK_URL,
-                json={
-                    "brand": "System_Alert",
-                    "content": f"🚨 Python脚本报警 [{level}]: {message}",
-                    "message_id": "error_alert",
-                    "date": datetime.now().isoformat()
-                },
-                headers={'Authorization': N8N_AUTH_TOKEN} if N8N_AUTH_TOKEN else {},
-                timeout=15 
-            )
+        http_client = await get_http()
+        headers = {'Authorization': N8N_AUTH_TOKEN} if N8N_AUTH_TOKEN else {}
+        await http_client.post(
+            N8N_WEBHOOK_URL,
+            content=orjson.dumps({
+                "brand": "System_Alert",
+                "content": f"🚨 Python脚本报警 [{level}]: {message}",
+                "message_id": "error_alert",
+                "date": datetime.now().isoformat()
+            }),
+            headers={**headers, 'Content-Type': 'application/json'},
+            timeout=15
+        )
         logger.info("✅ Error alert sent to n8n.")
     except Exception as e:
         logger.error(f"⚠️ Failed to send error alert: {e}")
 
-def upload_to_supabase_with_retry(supabase_client, bucket_name, file_path, folder_name, max_retries=3):
+# 超过该大小的媒体从内存溢写到磁盘，避免大视频占满 RSS
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+def media_buffer(temp_dir):
     """
-    Supabase 上传函数 (同步版)
-    运行在独立线程中，避免阻塞主线程心跳
+    下载缓冲区工厂：小文件全程留在内存 (省掉两次磁盘往返)，
+    大文件由 SpooledTemporaryFile 自动溢写到临时目录
     """
-    file_name = os.path.basename(file_path)
-    # 简单的文件名防止覆盖
-    remote_path = f"{folder_name}/{int(datetime.now().timestamp())}_{file_name}"
-    mime_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
-    
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=temp_dir)
+
+def media_file_name(message):
+    """
+    从 Document 属性直接取文件名，不依赖落盘
+    无名媒体 (如频道照片) 用消息 ID + 真实扩展名兜底，保证 MIME 查表仍命中
+    """
+    f = message.file
+    if f is None:
+        return f"{message.id}.bin"
+    return f.name or f"{message.id}{f.ext or '.bin'}"
+
+async def _aiter_file(fileobj, chunk_size=1 << 20):
+    """
+    按 1MB 块异步读取缓冲区，供 httpx 流式发送
+    内存缓冲直接读；溢写到磁盘的缓冲把 read 丢进线程池
+    (与 aiofiles 同机制)，读盘不会卡住事件循环
+    """
+    rolled = getattr(fileobj, '_rolled', True)
+    while True:
+        if rolled:
+            chunk = await asyncio.to_thread(fileobj.read, chunk_size)
+        else:
+            chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+async def upload_to_supabase_with_retry(supabase_url, supabase_key, bucket_name, fileobj, file_name, folder_name, max_retries=3, on_throttle=None):
+    """
+    Supabase 上传函数 (异步版)
+    全程异步 I/O，重试走指数退避，不再占用线程池工人
+    直连 Storage REST 并以流式发送缓冲区，避免整文件读入内存 (大视频可达几百 MB)
+    收到 429 时回调 on_throttle，让调用方把限流信号喂给自适应限制器
+    """
+    # uuid 前缀防止覆盖：秒级时间戳在并行上传下会撞名，uuid 恒定耗时且重试落到新路径
+    remote_path = f"{folder_name}/{uuid.uuid4().hex[:12]}_{file_name}"
+    ext = os.path.splitext(file_name)[1].lower()
+    mime_type = _MIME.get(ext, "application/octet-stream")
+
+    upload_url = f"{supabase_url}/storage/v1/object/{bucket_name}/{remote_path}"
+    upload_headers = {
+        "Authorization": f"Bearer {supabase_key}",
+        "Content-Type": mime_type,
+        "x-upsert": "true"
+    }
+
+    http_client = await get_http()
     for attempt in range(max_retries):
         try:
-            with open(file_path, 'rb') as f:
-                supabase_client.storage.from_(bucket_name).upload(
-                    path=remote_path,
-                    file=f,
-                    file_options={"content-type": mime_type}
-                )
-            public_url = supabase_client.storage.from_(bucket_name).get_public_url(remote_path)
+            fileobj.seek(0)
+            r = await http_client.post(upload_url, content=_aiter_file(fileobj), headers=upload_headers, timeout=120)
+            r.raise_for_status()
+            public_url = f"{supabase_url}/storage/v1/object/public/{bucket_name}/{remote_path}"
             # 返回 URL 和 Path (用于回滚)
             return public_url, remote_path
-            
+
         except Exception as e:
+            if on_throttle and isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+                await on_throttle()
             logger.warning(f"⚠️ Upload attempt {attempt+1}/{max_retries} failed: {e}")
-            time.sleep(2) 
-    
+            await asyncio.sleep(min(2 ** attempt, 30))
+
     logger.error(f"❌ Failed to upload {file_name} after {max_retries} attempts")
     return None, None
 
-def delete_from_supabase(supabase_client, bucket_name, paths):
+async def delete_from_supabase(sb_client, bucket_name, paths):
     """批量删除 Supabase 文件 (用于回滚)"""
     if not paths: return
     try:
-        supabase_client.storage.from_(bucket_name).remove(paths)
+        await sb_client.remove(bucket_name, paths)
         logger.info(f"🧹 Rolled back (deleted) {len(paths)} orphaned files.")
     except Exception as e:
         logger.error(f"⚠️ Failed to clean up orphaned files: {e}")
 
+async def scrape_channel(channel, entity, brand_folder, existing_ids_set, seen_groups, sem, client, supabase, supabase_url, supabase_key, bucket_name, temp_dir, cutoff_time, fetch_limit, manila_tz):
+    """
+    单频道抓取协程
+    限流器并发位由调用方 (run_channel) 先行获取，这里只在成功/限流时反馈调节
+    查重集合 (message_id 与 grouped_id) 由 main_logic 一次性批量预加载后传入
+    返回该频道的 payload 列表
+    """
+    payloads = []
+    overloaded = False
+
+    async def on_throttle():
+        # 限流信号 (FloodWait / 429) -> 乘性减只触发一次，并压掉本频道收尾的加性增
+        # 否则被 gather 吞掉的 FloodWait 会让频道"干净"结束并调高并发，形成正反馈
+        nonlocal overloaded
+        if not overloaded:
+            overloaded = True
+            await sem.on_overload()
+
+    logger.info(f"🔍 Checking channel: {channel} --> {brand_folder} ({len(existing_ids_set)} cached IDs)")
+
+    try:
+        # 抓取消息：先把整个窗口缓冲下来，本地按 grouped_id 聚合
+        # 相册成员就在已拉取的流里，不再为每个相册发第二次 RPC
+        window = [
+            m async for m in client.iter_messages(entity, offset_date=cutoff_time, reverse=True, limit=fetch_limit)
+            if not m.action and (m.text or m.media)
+        ]
+        groups = defaultdict(list)
+        for m in window:
+            groups[m.grouped_id or m.id].append(m)
+
+        for real_group in groups.values():
+            message = real_group[0]
+
+            # 内存查重
+            if str(message.id) in existing_ids_set:
+                continue
+            # 相册已入库 -> 跳过
+            if message.grouped_id and message.grouped_id in seen_groups:
+                continue
+
+            # 数据准备
+            media_urls = []
+            media_type = "text"
+            final_text = message.text or ""
+            final_msg_id = str(message.id)
+            is_payload_valid = True
+
+            # 分支 A: 媒体组 (Album)
+            if message.grouped_id:
+                media_type = "album"
+
+                # 记录本次相册上传的所有 path，用于回滚
+                album_uploaded_paths = []
+                upload_failed = False
+
+                # 下载/上传流水线：生产者下载，消费者上传，两端网络重叠
+                # 队列项带消息序号：并行完成顺序不定，收尾按序号排回 Telegram 原始顺序
+                media_msgs = [m for m in real_group if m.media]
+                uploaded_urls = []
+                num_consumers = 3
+                queue = asyncio.Queue(maxsize=4)
+
+                async def album_producer():
+                    nonlocal upload_failed
+                    # 并行下载相册项 (上限 4，防止单 session FloodWait)，完成即入队
+                    dl_sem = asyncio.Semaphore(4)
+
+                    async def download_one(idx, m):
+                        async with dl_sem:
+                            buf = media_buffer(temp_dir)
+                            try:
+                                await m.download_media(file=buf)
+                            except BaseException:
+                                # 下载中途失败 -> 立即释放缓冲区，不留孤儿 spool 文件
+                                buf.close()
+                                raise
+                        file_name = media_file_name(m)
+                        await queue.put((idx, buf, file_name))
+
+                    dl_results = await asyncio.gather(*(download_one(i, m) for i, m in enumerate(media_msgs)), return_exceptions=True)
+                    for res in dl_results:
+                        if isinstance(res, BaseException):
+                            # 下载失败等同上传失败：相册不完整就不能入库，触发回滚
+                            logger.warning(f"⚠️ Album download failed: {res}")
+                            upload_failed = True
+                            if isinstance(res, FloodWaitError):
+                                await on_throttle()
+                    for _ in range(num_consumers):
+                        await queue.put(None)
+
+                async def album_consumer():
+                    nonlocal upload_failed
+                    while True:
+                        item = await queue.get()
+                        if item is None:
+                            break
+                        idx, buf, file_name = item
+                        try:
+                            url, remote_path = await upload_to_supabase_with_retry(
+                                supabase_url, supabase_key, bucket_name, buf, file_name, brand_folder,
+                                on_throttle=on_throttle
+                            )
+                            if url:
+                                uploaded_urls.append((idx, url))
+                                album_uploaded_paths.append(remote_path)
+                            else:
+                                upload_failed = True
+                        finally:
+                            buf.close()
+
+                if media_msgs:
+                    await asyncio.gather(album_producer(), *(album_consumer() for _ in range(num_consumers)))
+                    # 上传完成顺序不可预测，按消息序号还原相册原始顺序
+                    media_urls = [url for _, url in sorted(uploaded_urls)]
+
+                if upload_failed:
+                    # 上传失败 -> 触发回滚
+                    error_msg = f"Supabase Upload Failed mid-album (Msg ID: {message.id})"
+                    logger.error(error_msg)
+                    await send_alert(error_msg, level="Upload_Error")
+                    is_payload_valid = False
+
+                    # 执行回滚：删除这个相册已经上传成功的图片
+                    if album_uploaded_paths:
+                        await delete_from_supabase(supabase, bucket_name, album_uploaded_paths)
+
+                # 即使上传失败，也要继续检查文本更新
+                for m in real_group:
+                    if m.text and len(m.text) > len(final_text):
+                        final_text = m.text
+
+            # 分支 B: 单媒体 (Photo/Video)
+            elif message.media:
+                media_type = "photo" if message.photo else "video"
+                buf = media_buffer(temp_dir)
+                try:
+                    await message.download_media(file=buf)
+                    file_name = media_file_name(message)
+                    url, _ = await upload_to_supabase_with_retry(
+                        supabase_url, supabase_key, bucket_name, buf, file_name, brand_folder,
+                        on_throttle=on_throttle
+                    )
+
+                    if url:
+                        media_urls.append(url)
+                    else:
+                        error_msg = f"Supabase Upload Failed (Msg ID: {message.id})"
+                        logger.error(error_msg)
+                        await send_alert(error_msg, level="Upload_Error")
+                        is_payload_valid = False
+                finally:
+                    buf.close()
+
+            # 分支 C: 纯文本
+            else:
+                media_type = "text"
+
+            # 构建 Payload
+            if is_payload_valid:
+                payload = {
+                    "source_channel": channel,
+                    "brand": brand_folder,
+                    "content": final_text,
+                    "media_urls": media_urls,
+                    "media_type": media_type,
+                    "message_id": final_msg_id,
+                    "grouped_id": message.grouped_id,
+                    "date": message.date.astimezone(manila_tz).isoformat()
+                }
+                payloads.append(payload)
+                logger.info(f"✅ Prepared payload: {final_msg_id} ({media_type})")
+            else:
+                logger.warning(f"⚠️ Skipping Payload ID {final_msg_id} due to upload failure.")
+
+        if not overloaded:
+            await sem.on_success()
+
+    except FloodWaitError as e:
+        # 触发 Telegram 限流 -> 收紧全局并发
+        if not overloaded:
+            await sem.on_overload()
+        err_msg = f"❌ FloodWait on channel {channel}: wait {e.seconds}s"
+        logger.error(err_msg)
+        await send_alert(err_msg, level="Channel_Scrape_Error")
+    except Exception as e:
+        err_msg = f"❌ Error scraping channel {channel}: {e}"
+        logger.error(err_msg)
+        await send_alert(err_msg, level="Channel_Scrape_Error")
+
+    return payloads
+
 async def main_logic():
     """主逻辑封装"""
     start_time = time.time()
@@ -108,41 +535,32 @@ async def main_logic():
         raise ValueError(error_msg)
 
     # 解析频道映射
-    raw_targets = target_channels_env.split(',')
-    channel_map = {}
-    for item in raw_targets:
-        if ':' in item:
-            parts = item.strip().split(':')
-            if len(parts) == 2:
-                key = parts[0].strip()
-                val = parts[1].strip()
-                channel_map[key] = val if val else "Uncategorized"
-        elif item.strip():
-            channel_map[item.strip()] = "Uncategorized"
+    channel_map = parse_channel_map(target_channels_env)
 
     logger.info("🚀 Daily Service Script Started...")
-    logger.info(f"📂 Brand Mapping: {channel_map}") 
+    if not _HAS_CRYPTG:
+        logger.warning("⚠️ cryptg not installed; Telethon falls back to pure-Python AES (slow downloads).")
+    logger.info(f"📂 Brand Mapping: {channel_map}")
 
     # 初始化 Telegram Client
-    client = TelegramClient(
-        StringSession(session_string), 
-        api_id, 
-        api_hash,
-        connection_retries=5, 
-        auto_reconnect=True,
-        request_retries=3,
-        device_model="N8N_Worker_Server", 
-        system_version="Linux_Railway_Env",
-        app_version="2.0.0"
-    )
-    
-    supabase = create_client(supabase_url, supabase_key)
+    client = get_client(session_string, api_id, api_hash)
+
+    supabase = SbClient(supabase_url, supabase_key)
     BUCKET_NAME = "daily_post_assets"
 
-    # 连接 Telegram
+    # 连接 Telegram (重试走指数退避 + 抖动，网络闪断时快速恢复，不傻等固定间隔)
     try:
         logger.info("📡 Connecting to Telegram...")
-        await client.connect()
+        for attempt in range(5):
+            try:
+                await client.connect()
+                break
+            except Exception as e:
+                if attempt == 4:
+                    raise
+                wait = min(60, 2 ** attempt) + random.random()
+                logger.warning(f"⚠️ Connect attempt {attempt+1}/5 failed: {e}; retrying in {wait:.1f}s")
+                await asyncio.sleep(wait)
         if not await client.is_user_authorized():
             await send_alert("❌ Session Invalid/Expired. Please update TG_SESSION_STRING.", level="Fatal")
             os._exit(1)
@@ -151,9 +569,30 @@ async def main_logic():
         await send_alert(f"🔥 Connection Failed: {str(e)}", level="Fatal")
         raise e 
 
+    # 预解析频道实体：每个用户名只做一次 ResolveUsername RPC，
+    # 并发抓取时不再重复解析
+    # 单个失效/改名的用户名只跳过该频道，不拖垮整个每日任务
+    resolved = await asyncio.gather(*(client.get_input_entity(c) for c in channel_map), return_exceptions=True)
+    entity_map = {}
+    failed_channels = []
+    for ch, res in zip(channel_map.keys(), resolved):
+        if isinstance(res, BaseException):
+            logger.error(f"❌ Failed to resolve channel {ch}: {res}")
+            failed_channels.append(ch)
+        else:
+            entity_map[ch] = res
+    if failed_channels:
+        await send_alert(f"❌ Failed to resolve channels, skipping: {', '.join(failed_channels)}", level="Channel_Scrape_Error")
+    if not entity_map:
+        await send_alert("❌ Failed to resolve all channel entities.", level="Fatal")
+        raise ValueError("No channel entities could be resolved.")
+    logger.info(f"🔗 Resolved {len(entity_map)}/{len(channel_map)} channel entities.")
+
     # 配置加载 (时间窗口)
+    # cutoff 直接用 UTC：Telethon 内部按 UTC 比较 offset_date，
+    # 传非 UTC 时区会让每条消息多一次时区归一化；马尼拉时区只用于展示和 payload 日期
     manila_tz = timezone(timedelta(hours=8))
-    now_manila = datetime.now(manila_tz)
+    now_utc = datetime.now(timezone.utc)
     
     try:
         fetch_hours = int(os.environ.get('FETCH_HOURS', 26))
@@ -165,184 +604,93 @@ async def main_logic():
     except ValueError:
         fetch_limit = 200
 
-    cutoff_time = now_manila - timedelta(hours=fetch_hours)
-    logger.info(f"⚙️ Config: Lookback={fetch_hours}h (Cutoff: {cutoff_time}), Limit={fetch_limit}")
+    try:
+        max_concurrent_channels = int(os.environ.get('MAX_CONCURRENT_CHANNELS', 4))
+    except ValueError:
+        max_concurrent_channels = 4
+
+    cutoff_time = now_utc - timedelta(hours=fetch_hours)
+    logger.info(f"⚙️ Config: Lookback={fetch_hours}h (Cutoff: {cutoff_time.astimezone(manila_tz)}), Limit={fetch_limit}, Concurrency={max_concurrent_channels}")
 
-    processed_groups = set()
     payloads = []
 
+    # 查重逻辑 (单次批量预加载所有频道，避免 O(C) 次 DB 往返)
+    ids_by_key = defaultdict(set)
+    groups_by_key = defaultdict(set)
+    try:
+        preload_cutoff = (now_utc - timedelta(hours=fetch_hours * 2)).isoformat()
+        all_existing = await supabase.select_archive(list(channel_map.keys()), preload_cutoff)
+
+        for row in all_existing:
+            ids_by_key[(row['source_channel'], row['brand'])].add(row['message_id'])
+            if row.get('grouped_id'):
+                groups_by_key[(row['source_channel'], row['brand'])].add(row['grouped_id'])
+        logger.info(f"📚 Preloaded {len(all_existing)} existing IDs across {len(channel_map)} channels.")
+    except Exception as e:
+        logger.error(f"⚠️ Batch Check Error: {e}")
+        # 继续执行，依靠后续逻辑
+
     # 临时目录管理
     with tempfile.TemporaryDirectory() as temp_dir:
-        
-        # 遍历频道
-        for channel, brand_folder in channel_map.items():
-            logger.info(f"🔍 Checking channel: {channel} --> {brand_folder}")
-            
-            # 查重逻辑 (批量预加载)
-            existing_ids_set = set()
-            try:
-                db_check_limit = max(fetch_limit * 2, 1000)
-                
-                existing_data = supabase.table('daily_post_archive') \
-                    .select('message_id') \
-                    .eq('brand', brand_folder) \
-                    .eq('source_channel', channel) \
-                    .order('inserted_at', desc=True) \
-                    .limit(db_check_limit) \
-                    .execute()
-                
-                existing_ids_set = {row['message_id'] for row in existing_data.data}
-                logger.info(f"📚 Loaded {len(existing_ids_set)} existing IDs for cache.")
-            except Exception as e:
-                logger.error(f"⚠️ Batch Check Error: {e}")
-                # 继续执行，依靠后续逻辑
 
-            try:
-                # 抓取消息
-                async for message in client.iter_messages(channel, offset_date=cutoff_time, reverse=True, limit=fetch_limit):
-                    
-                    if message.action: continue 
-                    if not message.text and not message.media: continue
-                    
-                    # 内存查重
-                    if str(message.id) in existing_ids_set:
-                        continue
-
-                    # 数据准备
-                    media_urls = []
-                    media_type = "text"
-                    final_text = message.text or ""
-                    final_msg_id = str(message.id)
-                    is_payload_valid = True 
-
-                    # 分支 A: 媒体组 (Album)
-                    if message.grouped_id:
-                        if message.grouped_id in processed_groups: continue 
-                        processed_groups.add(message.grouped_id)
-                        media_type = "album"
-                        
-                        group_msgs = await client.get_messages(channel, ids=list(range(message.id, message.id + 9)))
-                        real_group = [m for m in group_msgs if m and m.grouped_id == message.grouped_id]
-                        if not real_group: real_group = [message]
-
-                        # 记录本次相册上传的所有 path，用于回滚
-                        album_uploaded_paths = []
-
-                        for m in real_group:
-                            if m.media:
-                                path = None
-                                try:
-                                    path = await m.download_media(file=temp_dir)
-                                    if path:
-                                        # 上传
-                                        url, remote_path = await asyncio.to_thread(
-                                            upload_to_supabase_with_retry, 
-                                            supabase, BUCKET_NAME, path, brand_folder
-                                        )
-
-                                        if url: 
-                                            media_urls.append(url)
-                                            album_uploaded_paths.append(remote_path)
-                                        else:
-                                            # 上传失败 -> 触发回滚
-                                            error_msg = f"Supabase Upload Failed mid-album (Msg ID: {message.id})"
-                                            logger.error(error_msg)
-                                            await send_alert(error_msg, level="Upload_Error")
-                                            is_payload_valid = False
-                                            
-                                            # 执行回滚：删除这个相册之前已经上传成功的图片
-                                            if album_uploaded_paths:
-                                                await asyncio.to_thread(
-                                                    delete_from_supabase,
-                                                    supabase, BUCKET_NAME, album_uploaded_paths
-                                                )
-                                            break
-                                finally:
-                                    if path and os.path.exists(path):
-                                        try: os.remove(path)
-                                        except: pass
-                            
-                            # 即使中断，也要继续检查文本更新
-                            if m.text and len(m.text) > len(final_text):
-                                final_text = m.text
-                    
-                    # 分支 B: 单媒体 (Photo/Video)
-                    elif message.media:
-                        media_type = "photo" if message.photo else "video"
-                        path = None
-                        try:
-                            path = await message.download_media(file=temp_dir)
-                            if path:
-                                url, _ = await asyncio.to_thread(
-                                    upload_to_supabase_with_retry, 
-                                    supabase, BUCKET_NAME, path, brand_folder
-                                )
-                                
-                                if url: 
-                                    media_urls.append(url)
-                                else:
-                                    error_msg = f"Supabase Upload Failed (Msg ID: {message.id})"
-                                    logger.error(error_msg)
-                                    await send_alert(error_msg, level="Upload_Error")
-                                    is_payload_valid = False
-                        finally:
-                            if path and os.path.exists(path):
-                                try: os.remove(path)
-                                except: pass
-                    
-                    # 分支 C: 纯文本
-                    else:
-                        media_type = "text"
-
-                    # 构建 Payload
-                    if is_payload_valid:
-                        payload = {
-                            "source_channel": channel,
-                            "brand": brand_folder,
-                            "content": final_text,
-                            "media_urls": media_urls, 
-                            "media_type": media_type,
-                            "message_id": final_msg_id,
-                            "date": message.date.astimezone(manila_tz).isoformat()
-                        }
-                        payloads.append(payload)
-                        logger.info(f"✅ Prepared payload: {final_msg_id} ({media_type})")
-                    else:
-                        logger.warning(f"⚠️ Skipping Payload ID {final_msg_id} due to upload failure.")
+        # 并发抓取所有频道 (自适应限流器控制并发度，防止 FloodWait)
+        # TaskGroup 结构化并发：子任务失败会被干净地取消并归组上报
+        sem = AdaptiveLimiter(min_concurrency=1, max_concurrency=max_concurrent_channels, initial=2)
 
-            except Exception as e:
-                err_msg = f"❌ Error scraping channel {channel}: {e}"
-                logger.error(err_msg)
-                await send_alert(err_msg, level="Channel_Scrape_Error")
-                continue
-    
-    # 推送 n8n (串行模式 - 保持稳健)
+        async def run_channel(channel, brand_folder):
+            # 单频道硬超时，防止卡死的频道拖垮整个任务
+            # 超时在任务内消化，只丢本频道的结果，不连坐取消其他频道
+            # 先拿到限流器并发位再起计时：600s 预算只覆盖真正的抓取，排队不烧预算
+            async with sem:
+                try:
+                    result = await asyncio.wait_for(
+                        scrape_channel(channel, entity_map[channel], brand_folder, ids_by_key[(channel, brand_folder)], groups_by_key[(channel, brand_folder)], sem, client, supabase, supabase_url, supabase_key, BUCKET_NAME, temp_dir, cutoff_time, fetch_limit, manila_tz),
+                        timeout=600
+                    )
+                except TimeoutError:
+                    err_msg = f"❌ Channel scrape timed out (>600s): {channel}"
+                    logger.error(err_msg)
+                    await send_alert(err_msg, level="Channel_Scrape_Error")
+                    return
+            payloads.extend(result)
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for channel, brand_folder in channel_map.items():
+                    if channel in entity_map:
+                        tg.create_task(run_channel(channel, brand_folder))
+        except* FloodWaitError as eg:
+            err_msg = f"❌ FloodWait during scrape: {[str(e) for e in eg.exceptions]}"
+            logger.error(err_msg)
+            await send_alert(err_msg, level="Channel_Scrape_Error")
+        except* Exception as eg:
+            err_msg = f"❌ Channel task crashed: {[str(e) for e in eg.exceptions]}"
+            logger.error(err_msg)
+            await send_alert(err_msg, level="Channel_Scrape_Error")
+
+    # 批量写入 daily_post_archive (单事务单往返)
+    # n8n 改由 daily_post_archive 的 INSERT 触发器 (pg_net -> webhook) 通知，
+    # Python 端不再逐条/逐批 POST webhook
     if payloads:
-        logger.info(f"🚀 Pushing {len(payloads)} items to n8n...")
-        headers = {'Authorization': N8N_AUTH_TOKEN} if N8N_AUTH_TOKEN else {}
+        logger.info(f"🚀 Inserting {len(payloads)} items into daily_post_archive...")
         success_count = 0
-        fail_count = 0
+        fail_count = len(payloads)
 
-        async with httpx.AsyncClient(timeout=5.0) as http_client:
-            for p in payloads:
-                try:
-                    r = await http_client.post(N8N_WEBHOOK_URL, json=p, headers=headers)
-                    if r.status_code == 200:
-                        logger.info(f"✅ Sent ID {p['message_id']} to n8n")
-                        success_count += 1
-                    else:
-                        logger.warning(f"⚠️ Webhook Failed {r.status_code} for ID {p['message_id']}")
-                        fail_count += 1
-                    await asyncio.sleep(1) 
-                except Exception as e:
-                    logger.error(f"⚠️ Webhook Connection Error: {e}")
-                    fail_count += 1
-        
-        summary_msg = f"📊 Job Summary: Scraped {len(payloads)}, Sent {success_count}, Failed {fail_count}."
+        for attempt in range(3):
+            try:
+                await supabase.insert_archive(payloads)
+                success_count = len(payloads)
+                fail_count = 0
+                break
+            except Exception as e:
+                logger.error(f"⚠️ Bulk insert attempt {attempt+1}/3 failed: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+        summary_msg = f"📊 Job Summary: Scraped {len(payloads)}, Inserted {success_count}, Failed {fail_count}."
         logger.info(summary_msg)
-        
+
         if fail_count > 0:
-             await send_alert(f"⚠️ Some items failed to push to n8n. {fail_count} failures.", level="Webhook_Warning")
+             await send_alert(f"⚠️ Bulk insert to daily_post_archive failed. {fail_count} items not archived.", level="Insert_Error")
 
     else:
         logger.info("💤 No new content found (or all skipped).")
@@ -353,19 +701,25 @@ async def main_logic():
     
     logger.info(f"👋 Job Complete. Duration: {time.time() - start_time:.2f}s")
 
+async def run():
+    """入口包装：保证全局 HTTP 连接池在事件循环退出前被关闭"""
+    try:
+        await main_logic()
+    finally:
+        await close_http()
+
 # 全局异常捕获 (遗言机制)
 if __name__ == '__main__':
     try:
-        asyncio.run(main_logic())
+        asyncio.run(run())
     except Exception as e:
-        # 立即打印日志，确保在控制台可见
-        error_msg = f"🔥 CRITICAL SCRIPT CRASH: {str(e)}\n\n{traceback.format_exc()}"
-        logger.critical(error_msg)
-        
-        # 尝试发送遗言到 n8n (同步阻塞等待)
+        # logging 自带惰性格式化，直接流式输出调用栈，不预拼接大字符串
+        logger.exception("🔥 CRITICAL SCRIPT CRASH")
+
+        # 尝试发送遗言到 n8n (同步阻塞等待)，只带异常类型+消息，完整栈看控制台日志
         try:
             print("🚨 Attempting to send death rattle to n8n...", file=sys.stderr)
-            asyncio.run(send_alert(error_msg, level="CRITICAL_CRASH"))
+            asyncio.run(send_alert(f"{type(e).__name__}: {e}", level="CRITICAL_CRASH"))
             print("✅ Death rattle sent.", file=sys.stderr)
         except Exception as alert_error:
             # 即使报警失败，也要打印到控制台，以便查阅 Railway 日志